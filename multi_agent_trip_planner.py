@@ -1,14 +1,34 @@
-# Add these three lines to override the default sqlite3 library
-__import__('pysqlite3')
+# Chroma (pulled in by crewai) needs sqlite >= 3.35; only swap in pysqlite3 when the built-in one is older
 import sys
-sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
+import sqlite3
+if sqlite3.sqlite_version_info < (3, 35, 0):
+    try:
+        import pysqlite3
+        sys.modules['sqlite3'] = pysqlite3
+    except ImportError:
+        # pysqlite3-binary is usually only installed on the deployment host
+        pass
 
-from crewai import Agent, Task, Crew
-from crewai.llm import LLM
 import streamlit as st
-from serpapi import GoogleSearch
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import asyncio
+import functools
+import hashlib
+import json
 import os
+import re
+import threading
 from datetime import date, timedelta
+from itertools import islice
+from string import Template
+from types import MappingProxyType
+
+# Turn off CrewAI's OpenTelemetry pings before crewai is first imported; setdefault lets a deployment opt back in
+os.environ.setdefault("CREWAI_TELEMETRY_OPT_OUT", "true")
+os.environ.setdefault("OTEL_SDK_DISABLED", "true")
 
 # --- Streamlit Page Configuration ---
 st.set_page_config(page_title="AI Trip Designer")
@@ -24,132 +44,268 @@ serpapi_api_key = st.sidebar.text_input(
 )
 
 # --- Initialize LLM ---
-llm = None
-if groq_api_key:
-    llm = LLM(
+@st.cache_resource
+def get_llm(api_key: str):
+    # One LLM client per API key for the whole process, instead of one per rerun.
+    # crewai is imported here so its heavy import chain runs once, not at the top of every rerun.
+    from crewai.llm import LLM
+    return LLM(
         model="llama3-70b-8192",
-        api_key=groq_api_key,
+        api_key=api_key,
         base_url="https://api.groq.com/openai/v1"
     )
 
 # --- Session State Management ---
-if "chat_stage" not in st.session_state:
-    st.session_state.chat_stage = "collecting"
-    st.session_state.user_data = {}
-    st.session_state.last_input = None
-    st.session_state.itinerary_text = ""
-    st.session_state.flight_info = ""
-    st.session_state.hotel_info = ""
-    st.session_state.messages = []
+# The tuple is rebuilt each run, so every session gets its own fresh dict/list defaults
+for key, default in (
+    ("chat_stage", "collecting"), ("user_data", {}), ("last_input", None), ("itinerary_text", ""),
+    ("flight_info", ""), ("hotel_info", ""), ("messages", []),
+):
+    st.session_state.setdefault(key, default)
+
+SERPAPI_URL = "https://serpapi.com/search.json"
+SERPAPI_TIMEOUT = (3, 15)  # (connect, read) seconds, so a hung response can't freeze the app
+SERPAPI_MAX_CONCURRENCY = 8  # in-flight SerpAPI requests across all sessions; also the pool size
+FLIGHT_CACHE_TTL = 10 * 60  # seconds; flight prices move fastest
+HOTEL_CACHE_TTL = 60 * 60
+
+# Built once at import; keys are already casefolded city names. Also the whitelist for hotel searches.
+IATA_MAPPING = MappingProxyType({
+    "ahmedabad": "AMD", "goa": "GOI", "delhi": "DEL", "mumbai": "BOM", "bangalore": "BLR",
+    "chennai": "MAA", "kolkata": "CCU", "hyderabad": "HYD", "jaipur": "JAI", "kochi": "COK",
+    "paris": "CDG", "london": "LHR", "new york": "JFK", "los angeles": "LAX", "tokyo": "NRT",
+    "dubai": "DXB", "singapore": "SIN", "sydney": "SYD", "toronto": "YYZ", "frankfurt": "FRA",
+    "hong kong": "HKG", "amsterdam": "AMS", "bangkok": "BKK", "shanghai": "PVG", "beijing": "PEK",
+    "seoul": "ICN", "doha": "DOH", "zurich": "ZRH", "kuala lumpur": "KUL"
+})
+
+# Per-night INR ceiling for each budget tier
+HOTEL_PRICE_CAPS = MappingProxyType({"low-range": 4000, "mid-range": 9000, "luxury": 90000})
 
 # --- Helper Functions for API Calls ---
-def get_flight_info(departure, arrival, days):
-    iata_mapping = {
-        "ahmedabad": "AMD", "goa": "GOI", "delhi": "DEL", "mumbai": "BOM", "bangalore": "BLR",
-        "chennai": "MAA", "kolkata": "CCU", "hyderabad": "HYD", "jaipur": "JAI", "kochi": "COK",
-        "paris": "CDG", "london": "LHR", "new york": "JFK", "los angeles": "LAX", "tokyo": "NRT",
-        "dubai": "DXB", "singapore": "SIN", "sydney": "SYD", "toronto": "YYZ", "frankfurt": "FRA",
-        "hong kong": "HKG", "amsterdam": "AMS", "bangkok": "BKK", "shanghai": "PVG", "beijing": "PEK",
-        "seoul": "ICN", "doha": "DOH", "zurich": "ZRH", "kuala lumpur": "KUL"
-    }
-    departure_code = iata_mapping.get(departure.lower().strip())
-    arrival_code = iata_mapping.get(arrival.lower().strip())
+def norm_city(name):
+    # Lookup/cache form of a city name. Preferences keep the name as typed (stripped) for the
+    # prompt and error lines; IATA lookups, the hotel whitelist and cache keys all go through this
+    return name.strip().casefold()
+
+def format_price(price):
+    return f"₹{price:,}" if isinstance(price, int) else f"₹{price}"
+
+def format_flight(flight):
+    get = flight.get
+    # dict.fromkeys dedupes in one pass and keeps segment order, so the output is stable
+    carrier = "/".join(dict.fromkeys(seg.get("airline", "-") for seg in get("flights", [])))
+    return f"- **{carrier}**: {format_price(get('price', 'N/A'))}"
+
+@st.cache_resource
+def get_serp_session() -> requests.Session:
+    # Pooled keep-alive connections to serpapi.com, reused across reruns.
+    # Connection errors and transient rate-limit/gateway errors are retried with jittered exponential
+    # backoff (each wait capped at 3s). Retry-After is ignored, so a 429/503 cannot stretch a wait past
+    # that cap. A read timeout is retried only once, so a hung SerpAPI response holds a concurrency
+    # slot for at most ~2 x 15s of reads plus a few seconds of backoff, not 4 x 18s.
+    retry = Retry(
+        total=3, read=1, backoff_factor=0.3, backoff_max=3, backoff_jitter=0.3,
+        status_forcelist=(429, 502, 503, 504), allowed_methods=("GET",), respect_retry_after_header=False
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=SERPAPI_MAX_CONCURRENCY, max_retries=retry))
+    return session
+
+@st.cache_resource
+def get_serp_limiter() -> threading.BoundedSemaphore:
+    # Shared by every session in the process, so many users planning at once stay under SerpAPI's rate limit
+    return threading.BoundedSemaphore(SERPAPI_MAX_CONCURRENCY)
+
+def serp_get(session, limiter, params):
+    with limiter:
+        resp = session.get(SERPAPI_URL, params=params, timeout=SERPAPI_TIMEOUT)
+    # google_hotels payloads run to hundreds of KB; orjson parses them several times faster than json
+    return orjson.loads(resp.content)
+
+async def serp_search(session, params):
+    # requests is blocking, so run it in a worker thread to keep the lookups concurrent
+    return await asyncio.to_thread(serp_get, session, get_serp_limiter(), params)
+
+@st.cache_resource
+def get_serp_cache():
+    import diskcache
+    return diskcache.Cache(".serpcache")
+
+def cached_lookup(kind, ttl):
+    # Disk-backed TTL cache for a lookup helper, keyed on its normalized arguments, so "Paris" and
+    # " paris" share one entry. Error results are never stored, so a failed search is retried next time.
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(session, *args):
+            key_args = [norm_city(a) if isinstance(a, str) else a for a in args]
+            key = hashlib.sha1(json.dumps({"fn": kind, "args": key_args}, sort_keys=True).encode()).hexdigest()
+            cache = get_serp_cache()
+            text = cache.get(key)
+            if text is None:
+                text = await fn(session, *args)
+                if not text.startswith("❌"):
+                    cache.set(key, text, expire=ttl)
+            return text
+        return wrapper
+    return decorator
+
+@cached_lookup("flights", ttl=FLIGHT_CACHE_TTL)
+async def get_flight_info(session, departure, arrival, depart_date, return_date):
+    departure_code = IATA_MAPPING.get(norm_city(departure))
+    arrival_code = IATA_MAPPING.get(norm_city(arrival))
     if not departure_code or not arrival_code:
         return f"❌ Could not find airport code for {departure} or {arrival}."
 
-    depart_date = (date.today() + timedelta(days=30)).isoformat()
-    return_date = (date.today() + timedelta(days=30 + days)).isoformat()
     params = {
         "engine": "google_flights", "departure_id": departure_code, "arrival_id": arrival_code,
         "outbound_date": depart_date, "return_date": return_date, "currency": "INR",
-        "hl": "en", "gl": "in", "api_key": serpapi_api_key
+        "hl": "en", "gl": "in", "no_cache": "false", "async": "false", "api_key": serpapi_api_key
     }
     try:
-        search = GoogleSearch(params)
-        results = search.get_dict()
+        results = await serp_search(session, params)
         if "error" in results: return f"❌ SerpAPI Error: {results['error']}"
         flights = results.get("best_flights", []) or results.get("other_flights", [])
         if not flights: return "❌ No flights found."
-        lines = ["**✈️ Flight Options:**"]
-        for f in flights[:3]:
-            price = f.get("price", "N/A")
-            carrier = "/".join(list(set(seg.get("airline", "-") for seg in f.get("flights", []))))
-            lines.append(f"- **{carrier}**: ₹{price:,}" if isinstance(price, int) else f"- **{carrier}**: ₹{price}")
-        return "\n".join(lines)
+        return "\n".join(["**✈️ Flight Options:**", *[format_flight(f) for f in flights[:3]]])
     except Exception as e:
         return f"❌ Exception during flight search: {e}"
 
-def get_hotel_info(city, budget, days):
-    check_in = (date.today() + timedelta(days=30)).isoformat()
-    check_out = (date.today() + timedelta(days=30 + days)).isoformat()
+@cached_lookup("hotels", ttl=HOTEL_CACHE_TTL)
+async def get_hotel_info(session, city, budget, check_in, check_out):
+    # Search only cities we know, so a typo doesn't spend a paid SerpAPI credit
+    if norm_city(city) not in IATA_MAPPING:
+        return f"❌ Hotel search is not supported for {city}."
+
     params = {
         "engine": "google_hotels", "q": f"hotels in {city}", "currency": "INR",
         "check_in_date": check_in, "check_out_date": check_out, "adults": "1",
-        "hl": "en", "gl": "in", "api_key": serpapi_api_key
+        "hl": "en", "gl": "in", "no_cache": "false", "async": "false", "api_key": serpapi_api_key
     }
     try:
-        search = GoogleSearch(params)
-        results = search.get_dict()
+        results = await serp_search(session, params)
         if "error" in results: return f"❌ SerpAPI Error: {results['error']}"
         props = results.get("properties", [])
         if not props: return "❌ No hotels found."
-        price_caps = {"low-range": 4000, "mid-range": 9000, "luxury": 90000}
-        cap = price_caps.get(budget, 9000)
-        shortlist = ["**🏨 Hotel Options:**"]
-        for h in props:
-            price = h.get("rate_per_night", {}).get("extracted_lowest")
-            if price and price <= cap:
-                shortlist.append(f"- **{h['name']}**: ₹{int(price):,}/night")
-            if len(shortlist) == 4: break
-        return "\n".join(shortlist) if len(shortlist) > 1 else "❌ No hotels matched budget."
+        cap = HOTEL_PRICE_CAPS.get(budget, 9000)
+        in_budget = (
+            (h["name"], price) for h in props
+            if (price := (h.get("rate_per_night") or {}).get("extracted_lowest")) and price <= cap
+        )
+        # islice stops scanning as soon as three hotels under the cap are found
+        picks = list(islice(in_budget, 3))
+        if not picks: return "❌ No hotels matched budget."
+        return "\n".join(["**🏨 Hotel Options:**", *[f"- **{name}**: {format_price(int(price))}/night" for name, price in picks]])
     except Exception as e:
         return f"❌ Exception during hotel search: {e}"
 
-def generate_full_itinerary(prefs):
-    flights_txt = get_flight_info(prefs['departure'], prefs['destination'], prefs['days'])
-    hotels_txt = get_hotel_info(prefs['destination'], prefs['budget'], prefs['days'])
-    
-    # *** MAJOR CHANGE: Replaced CrewAI with a direct, more reliable LLM call ***
-    prompt = f"""
-        You are an expert travel planner. Your single task is to generate a complete travel itinerary based on the details provided.
-        You must follow the specified format exactly. Do not add any conversational text, introductions, or explanations.
-        Your entire response should be only the formatted markdown itinerary.
+@functools.lru_cache(maxsize=64)
+def trip_window(today_ordinal, days):
+    # Trips start 30 days out; computed once so flights and hotels always agree on the dates.
+    # Keyed on today's ordinal, so entries roll over exactly at midnight.
+    start = date.fromordinal(today_ordinal) + timedelta(days=30)
+    return start.isoformat(), (start + timedelta(days=days)).isoformat()
+
+async def gather_travel_data(departure, destination, budget, start, end):
+    # Flight and hotel lookups are independent, so run them concurrently over one session
+    session = get_serp_session()
+    return await asyncio.gather(
+        get_flight_info(session, departure, destination, start, end),
+        get_hotel_info(session, destination, budget, start, end),
+    )
+
+def fetch_travel_data(departure, destination, budget, start, end):
+    return asyncio.run(gather_travel_data(departure, destination, budget, start, end))
+
+# The instructions never change, so they go in the system message, which providers with
+# prompt caching reuse across requests; only the short trip block below is filled per call.
+# Kept terse: prefill cost grows with every prompt token.
+ITINERARY_SYSTEM_PROMPT = """You are an expert travel planner. Reply with only this markdown itinerary, no introduction or commentary:
 
-        **Trip Details:**
-        - **Destination:** {prefs['destination']}
-        - **Duration:** {prefs['days']} days
-        - **Departure City:** {prefs['departure']}
-        - **Budget:** {prefs['budget']}
+### Trip Summary
+One paragraph summarizing the trip.
 
-        **Available Data (for context):**
-        - **Flight Options:** {flights_txt}
-        - **Hotel Options:** {hotels_txt}
+### Recommendations
+* **Flight:** one option from the flight data, with a one-sentence reason.
+* **Hotel:** one option from the hotel data, with a one-sentence reason.
 
-        **Required Output Format:**
+### Daily Itinerary
+**Day N:**
+* **Morning:** detailed activity
+* **Afternoon:** detailed activity
+* **Evening:** detailed activity
 
-        ### Trip Summary
-        A brief, one-paragraph summary of the exciting trip ahead.
+Start with '### Trip Summary' and end with the last activity of the final day."""
 
-        ### Recommendations
-        * **Flight:** [Recommend one flight from the options and provide a one-sentence reason for your choice.]
-        * **Hotel:** [Recommend one hotel from the options and provide a one-sentence reason for your choice.]
+# One pass that also checks the sections come in order: Trip Summary before Daily Itinerary
+ITINERARY_FORMAT = re.compile(r"###\s*Trip Summary.*?###\s*Daily Itinerary", re.DOTALL)
+
+TRIP_PROMPT = Template("""Trip: $days days in $destination from $departure, $budget budget. Plan all $days days.
+Flights: $flights_txt
+Hotels: $hotels_txt""")
+
+def compact_options(text):
+    # "**✈️ Flight Options:**\n- **IndiGo**: ₹5,400" -> "IndiGo: ₹5,400"; error lines pass through as-is
+    if text.startswith("❌"):
+        return text
+    return "; ".join(line.lstrip("- ").replace("**", "") for line in text.splitlines()[1:])
+
+def stream_itinerary(prompt):
+    # Yield the itinerary as Groq generates it instead of blocking until the full response is ready
+    import litellm
+    # Resolved here rather than at the top of the script, so the form phase never imports crewai
+    llm = get_llm(groq_api_key)
+    response = litellm.completion(
+        model=llm.model, api_key=llm.api_key, base_url=llm.base_url, custom_llm_provider="openai",
+        messages=[
+            {"role": "system", "content": ITINERARY_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+        stream=True
+    )
+    for chunk in response:
+        yield chunk.choices[0].delta.content or ""
 
-        ### Daily Itinerary
-        **Day 1:**
-        * **Morning:** [Detailed activity, e.g., 'Visit the Louvre Museum (pre-booked tickets recommended).']
-        * **Afternoon:** [Detailed activity, e.g., 'Enjoy a picnic lunch at Champ de Mars with a view of the Eiffel Tower.']
-        * **Evening:** [Detailed activity, e.g., 'Take a sunset dinner cruise on the Seine River.']
+@st.cache_resource
+def get_plan_cache():
+    # Finished plans keyed on the normalized trip, kept on disk so a page reload or container
+    # restart within FLIGHT_CACHE_TTL can re-serve them without redoing the SerpAPI and LLM work
+    import diskcache
+    return diskcache.Cache(".plancache")
 
-        ... continue for all {prefs['days']} days ...
+def generate_full_itinerary(prefs, placeholder):
+    departure = prefs['departure']
+    destination = prefs['destination']
+    start, end = trip_window(date.today().toordinal(), prefs['days'])
+    # Normalized city names, so "Paris" and " paris" share one entry. The travel dates are part
+    # of the key, so a plan is never served for a different date window
+    plan_key = (norm_city(destination), prefs['budget'], norm_city(departure), start, end)
+    plans = get_plan_cache()
+    cached_plan = plans.get(plan_key)
+    if cached_plan is not None:
+        # An identical trip was already planned: skip both SerpAPI calls and the LLM run
+        return cached_plan
 
-        **IMPORTANT:** Your response must start with '### Trip Summary' and end with the last activity of the final day.
-      """
+    flights_txt, hotels_txt = fetch_travel_data(departure, destination, prefs['budget'], start, end)
+    
+    # *** MAJOR CHANGE: Replaced CrewAI with a direct, more reliable LLM call ***
+    prompt = TRIP_PROMPT.substitute(
+        destination=destination, days=prefs['days'], departure=departure,
+        budget=prefs['budget'], flights_txt=compact_options(flights_txt), hotels_txt=compact_options(hotels_txt)
+    )
     
     try:
-        response = llm.invoke(prompt)
-        result = response.content if hasattr(response, 'content') else str(response)
+        with placeholder.container():
+            st.markdown(f"{flights_txt}\n\n{hotels_txt}\n\n**📋 Your Custom Itinerary:**")
+            # write_stream renders tokens as they arrive and returns the concatenated text
+            result = st.write_stream(stream_itinerary(prompt))
         
-        if result and "Trip Summary" in result and "Daily Itinerary" in result:
+        if result and ITINERARY_FORMAT.search(result):
+            # Only complete plans are stored: a SerpAPI error line must not be pinned for every user
+            if not flights_txt.startswith("❌") and not hotels_txt.startswith("❌"):
+                # Same TTL as the flight lookup. flights_txt may itself come from a .serpcache entry
+                # up to FLIGHT_CACHE_TTL old, so a served plan's prices can be up to ~2 x that age
+                plans.set(plan_key, (flights_txt, hotels_txt, result), expire=FLIGHT_CACHE_TTL)
             return flights_txt, hotels_txt, result
         else:
             # This fallback is now much less likely to be needed
@@ -158,7 +314,7 @@ def generate_full_itinerary(prefs):
         return flights_txt, hotels_txt, f"❌ An error occurred while communicating with the AI model: {e}"
 
 # --- Main App Logic ---
-if not llm or not serpapi_api_key:
+if not groq_api_key or not serpapi_api_key:
     st.info("Please enter your API keys in the sidebar to start planning.")
     st.stop()
 
@@ -167,48 +323,45 @@ for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
-# --- Original UI Logic (Restored and Fixed) ---
-user_input = st.chat_input("Your response...")
-
+# --- Trip Preferences Form ---
+# All four answers are submitted together, so collecting them costs one rerun instead of four
 if st.session_state.chat_stage == "collecting":
-    if not st.session_state.messages or st.session_state.messages[-1]["role"] == "user":
-        if "destination" not in st.session_state.user_data:
-            st.session_state.messages.append({"role": "assistant", "content": "Where would you like to travel?"})
-        elif "days" not in st.session_state.user_data:
-            st.session_state.messages.append({"role": "assistant", "content": "How many days will your trip be?"})
-        elif "budget" not in st.session_state.user_data:
-            st.session_state.messages.append({"role": "assistant", "content": "What's your budget? (low-range, mid-range, luxury)"})
-        elif "departure" not in st.session_state.user_data:
-            st.session_state.messages.append({"role": "assistant", "content": "Which city will you be departing from?"})
-        st.rerun()
-
-if user_input:
-    st.session_state.messages.append({"role": "user", "content": user_input})
-    
-    if st.session_state.chat_stage == "collecting":
-        if "destination" not in st.session_state.user_data:
-            st.session_state.user_data["destination"] = user_input
-        elif "days" not in st.session_state.user_data:
-            try:
-                st.session_state.user_data["days"] = int(user_input)
-            except ValueError:
-                st.session_state.messages.append({"role": "assistant", "content": "Please enter a valid number."})
-        elif "budget" not in st.session_state.user_data:
-            st.session_state.user_data["budget"] = user_input.lower().strip()
-        elif "departure" not in st.session_state.user_data:
-            st.session_state.user_data["departure"] = user_input
+    form_slot = st.empty()
+    with form_slot.container():
+        with st.form("prefs"):
+            destination = st.text_input("Where would you like to travel?")
+            days = st.number_input("How many days will your trip be?", min_value=1, value=3, step=1)
+            budget = st.selectbox("What's your budget?", ["low-range", "mid-range", "luxury"], index=1)
+            departure = st.text_input("Which city will you be departing from?")
+            submitted = st.form_submit_button("Plan my trip")
+
+    if submitted:
+        if not destination.strip() or not departure.strip():
+            st.warning("Please enter both a destination and a departure city.")
+        else:
+            st.session_state.user_data = {
+                "destination": destination.strip(), "days": int(days), "budget": budget,
+                "departure": departure.strip()
+            }
+            summary = f"{int(days)}-day {budget} trip to {destination} from {departure}"
+            st.session_state.messages.append({"role": "user", "content": summary})
             st.session_state.chat_stage = "planning"
-    
-    st.rerun()
+            # Fall through to planning in this same run instead of paying for an extra st.rerun()
+            form_slot.empty()
+            with st.chat_message("user"):
+                st.markdown(summary)
 
 if st.session_state.chat_stage == "planning":
+    with st.chat_message("assistant"):
+        placeholder = st.empty()
     with st.spinner("Agents are crafting your perfect itinerary..."):
-        flights, hotels, itinerary = generate_full_itinerary(st.session_state.user_data)
+        flights, hotels, itinerary = generate_full_itinerary(st.session_state.user_data, placeholder)
         st.session_state.flight_info = flights
         st.session_state.hotel_info = hotels
         st.session_state.itinerary_text = itinerary
         
         final_response = f"{flights}\n\n{hotels}\n\n**📋 Your Custom Itinerary:**\n\n{itinerary}"
+        # The reply is already on screen in its live container, so record it without a full rerun
+        placeholder.markdown(final_response)
         st.session_state.messages.append({"role": "assistant", "content": final_response})
         st.session_state.chat_stage = "done"
-        st.rerun()